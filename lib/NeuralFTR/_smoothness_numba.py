@@ -0,0 +1,24 @@
+from numba import njit, prange
+
+
+###########################
+# CPU kernel for the smoothness loss of the Trainer (only used for evaluation, no gradients):
+# the first order backward differences of a (B, C, H, W) field with replicated boundary
+# (i.e. zero difference in the first row/column) are squared and summed in a single pass.
+###########################
+
+@njit(parallel=True, fastmath=True, cache=True)
+def grad_sq_sum(field, inv_dx, inv_dy):
+    B, C, H, W = field.shape
+    total = 0.0
+    for b in prange(B):
+        for c in range(C):
+            for i in range(H):
+                for j in range(W):
+                    if i > 0:
+                        dfx = (field[b, c, i, j] - field[b, c, i - 1, j]) * inv_dx
+                        total += dfx * dfx
+                    if j > 0:
+                        dfy = (field[b, c, i, j] - field[b, c, i, j - 1]) * inv_dy
+                        total += dfy * dfy
+    return total
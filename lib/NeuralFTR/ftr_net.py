@@ -1,5 +1,7 @@
 import torch.nn as nn
 import torch
+from torch.utils.checkpoint import checkpoint
+from contextlib import contextmanager, nullcontext
 import os
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -142,21 +144,44 @@ class FTR_Dec_1Lay(BaseModule):
         return modes
 
 
+@contextmanager
+def _keep_batchnorm_stats(module):
+    # the BatchNorm running statistics were already updated in the forward pass, keep them unchanged when the
+    # activations are recomputed in the backward pass (also if the recomputation is stopped early)
+    buffers = [buf for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) for buf in m.buffers()]
+    saved = [buf.clone() for buf in buffers]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for buf, val in zip(buffers, saved):
+                buf.copy_(val)
+
+
 class FTR_AE(BaseModule):
-    def __init__(self, encoder=None, decoder=None, dof=10, f=nn.Sigmoid, spatial_shape=[128, 128]):
+    def __init__(self, encoder=None, decoder=None, dof=10, f=nn.Sigmoid, spatial_shape=[128, 128], use_checkpoint=False):
         super(self.__class__, self).__init__()
         self.has_bottleneck = True
+        # recompute the encoder/decoder activations in the backward pass instead of storing them. This frees
+        # enough memory to roughly double the batch_size of the Trainer and amortize the kernel launch cost per step
+        self.use_checkpoint = use_checkpoint
         self.encoder = FTR_Enc(dof, spatial_shape=spatial_shape) if encoder is None else encoder
         self.decoder = FTR_Dec(dof, f) if decoder is None else decoder
 
+    def _run(self, module, *args, **kwargs):
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(module, *args, use_reentrant=False,
+                              context_fn=lambda: (nullcontext(), _keep_batchnorm_stats(module)), **kwargs)
+        return module(*args, **kwargs)
+
     def forward(self, q, return_code=False, apply_f=True, return_phi=False):
-        code = self.encoder(q)
+        code = self._run(self.encoder, q)
         returns = []
         if return_code:
             returns.append(code)
         if apply_f and return_phi:
-            returns += [*self.decoder(code, apply_f=apply_f, return_phi=return_phi)]
+            returns += [*self._run(self.decoder, code, apply_f=apply_f, return_phi=return_phi)]
         else:
-            returns += [self.decoder(code, apply_f)]
+            returns += [self._run(self.decoder, code, apply_f)]
             
         return returns
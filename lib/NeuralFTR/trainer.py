@@ -1,10 +1,15 @@
 import torch
-import torch.nn.functional as F
 import numpy as np
 import time
 import matplotlib.pyplot as plt
-from .utils import save_codeBase, to_torch
+from matplotlib.figure import Figure
+from concurrent.futures import ThreadPoolExecutor
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, TensorDataset, BatchSampler, RandomSampler
+from .utils import save_codeBase, to_torch, to_numpy
 import os
+import warnings
 
 try:
     import tensorboard
@@ -14,6 +19,13 @@ else:
     TB_MODE = True
     from torch.utils.tensorboard import SummaryWriter
 
+try:
+    from ._smoothness_numba import grad_sq_sum as _grad_sq_sum_numba
+except ImportError as e:
+    NUMBA_MODE = False
+else:
+    NUMBA_MODE = True
+
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
@@ -32,208 +44,403 @@ class Trainer(object):
                  lr_min=0.0001,
                  smooth_phi=0.0005,
                  log_folder='./train_results_local/',
-                 device=DEVICE
+                 device=DEVICE,
+                 compile_loss=False,
+                 amp_dtype=None,
+                 rank=0,
+                 world_size=1,
+                 local_rank=None,
+                 batch_size=None,
+                 cudnn_benchmark=True
                  ):
-        
-        self.net = net.to(device)
+
+        # data parallel training on several GPUs with one process per GPU (e.g. started with torchrun):
+        # every process trains on its share of the train_set, gradients are averaged by DDP and only
+        # the process with rank 0 evaluates, logs and saves checkpoints. The GPU of a process is given by its
+        # rank on the node (local_rank, by default LOCAL_RANK as set by torchrun). Call close() when done.
+        self.rank = rank
+        self.world_size = world_size
+        self.distributed = world_size > 1
+        if self.distributed:
+            local_rank = int(os.environ.get('LOCAL_RANK', rank)) if local_rank is None else local_rank
+            dist.init_process_group('nccl', rank=rank, world_size=world_size)
+            device = torch.device('cuda', local_rank)
+            torch.cuda.set_device(device)
+
+        # the input shapes are fixed during training, so cuDNN can benchmark the convolution algorithms once and
+        # cache the fastest; tf32 matmuls/convolutions on Ampere+. This costs a slower first step of every shape
+        # and makes the runs non-deterministic, use cudnn_benchmark=False for reproducible runs.
+        if cudnn_benchmark and torch.device(device).type == 'cuda':
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cudnn.deterministic = False
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
+        # NHWC layout lets cuDNN pick the tensor core kernels for the convolutions without layout conversions
+        self.net = net.to(device, memory_format=torch.channels_last)
+        self.train_net = DDP(self.net, device_ids=[device.index]) if self.distributed else self.net
         self.X = X
         self.Y = Y
-        self.Grid = torch.tensor(np.concatenate([X[None, ...], Y[None, ...]], 0), device=device)
+        self.Grid = torch.stack([torch.as_tensor(X, device=device, dtype=torch.float32),
+                                 torch.as_tensor(Y, device=device, dtype=torch.float32)], 0)
         self.train_set_params = train_set_params
-        self.train_set = train_set
-        self.test_set = test_set
+        # the data sets are fixed, so they are moved to the device once instead of in every training step
+        train_set = train_set[rank::world_size] if self.distributed and train_set is not None else train_set
+        self.train_set = to_torch(train_set, device).contiguous(memory_format=torch.channels_last) \
+            if train_set is not None else None
+        self.test_set = to_torch(test_set, device).contiguous(memory_format=torch.channels_last) \
+            if test_set is not None else None
+        # the norm of the train_set is constant, it is computed once for the reconstruction loss of full batch steps
+        self._train_q_norm_sq = self.train_set.pow(2).sum() if self.train_set is not None else None
+
+        # mini-batches of the train_set, batch_size=None trains on the full train_set in every step.
+        # The data already live on the device, so every batch is gathered with a single indexing operation
+        # in the main process and incomplete batches are dropped to keep the shapes fixed.
+        self.loader = None
+        if batch_size is not None and self.train_set is not None:
+            train_data = TensorDataset(self.train_set)
+            batch_size = min(batch_size, len(train_data))
+            sampler = BatchSampler(RandomSampler(train_data), batch_size=batch_size, drop_last=True)
+            self.loader = DataLoader(train_data, sampler=sampler, batch_size=None)
         self.optim = torch.optim.Adam(params=self.net.parameters(), lr=lr)
         self.lr_min = lr_min
         self.smooth_phi = smooth_phi
         self.logs_folder = log_folder
-        self.device = device
+        self.device = torch.device(device)
         self.tensorboard = None
+        # the tensorboard figures are drawn by a single background thread while the training continues,
+        # the thread is started and shut down in every call of training()
+        self._plot_executor = None
+        self._plot_future = None
+        # tensorboard figures, created on first use and updated in place afterwards
+        self._figures = {}
+
+        # mixed precision training: amp_dtype=torch.bfloat16 or torch.float16 runs the forward pass under autocast,
+        # the losses are evaluated in float32. float16 additionally needs loss scaling to avoid gradient underflow.
+        self.amp_dtype = amp_dtype
+        self.scaler = torch.amp.GradScaler(self.device.type, enabled=amp_dtype == torch.float16)
+
+        # grid spacings for the first order finite differences in smoothness_loss
+        # as python floats (computed on the host), so the loss does not depend on 0-dim tensors
+        X_np, Y_np = to_numpy(X), to_numpy(Y)
+        self.dx = float(X_np[0, 1] - X_np[0, 0]) or float(X_np[1, 0] - X_np[0, 0])
+        self.dy = float(Y_np[1, 0] - Y_np[0, 0]) or float(Y_np[0, 1] - Y_np[0, 0])
+        self.inv_dx = 1.0 / self.dx
+        self.inv_dy = 1.0 / self.dy
 
-        # Set up a kernel to compute the 2D 2nd order central finite difference along both axes via 2 conv2d channels
-        self.dx = self.X[0, 1] - self.X[0, 0] if (self.X[0, 1] - self.X[0, 0]) != 0 else self.X[1, 0] - self.X[0, 0]
-        self.dy = self.Y[1, 0] - self.Y[0, 0] if (self.Y[1, 0] - self.Y[0, 0]) != 0 else self.Y[0, 1] - self.Y[0, 0]
-        self.Dx_kernel = torch.ones([1, 1, 2, 1], device=self.device) / self.dx
-        self.Dy_kernel = torch.ones([1, 1, 1, 2], device=self.device) / self.dy
-        self.pady = torch.nn.ReplicationPad2d(padding=[1, 0, 0, 0])
-        self.padx = torch.nn.ReplicationPad2d(padding=[0, 0, 1, 0])
-        self.Dx_kernel[0, 0, 0, 0] *= -1
-        self.Dy_kernel[0, 0, 0, 0] *= -1
+        # optionally fuse the training loss (forward + losses) with inductor, the eager version is kept for evaluation.
+        # Verified on the CPU with FTR_Dec_1Lay only; the GPU path (CUDA graphs together with DDP, autocast and the
+        # BatchNorm buffer updates) is untested. Known failing configurations fall back to the eager loss.
+        compile_issue = self._compile_issue() if compile_loss else None
+        if compile_issue is not None:
+            warnings.warn(f"compile_loss=True is not supported {compile_issue}, the training loss runs eagerly")
+            compile_loss = False
+        if compile_loss and hasattr(torch, 'compile'):
+            self._loss_compiled = torch.compile(self._loss_fn, mode='reduce-overhead', dynamic=False)
+        else:
+            self._loss_compiled = self._loss_fn
         
+    def _compile_issue(self):
+        if self.device.type == 'cpu' and any(isinstance(m, torch.nn.ReplicationPad2d) for m in self.net.modules()):
+            # inductor fails with a stride assertion in the backward of ReplicationPad2d (e.g. FTR_Dec)
+            return "on the CPU for nets with ReplicationPad2d layers"
+        if any(getattr(m, 'use_checkpoint', False) for m in self.net.modules()):
+            # dynamo can not trace the context_fn that keeps the BatchNorm statistics during the recomputation
+            return "together with activation checkpointing (use_checkpoint=True)"
+        return None
+
+    def close(self):
+        if self.distributed and dist.is_initialized():
+            dist.destroy_process_group()
+
     def test(self):
+        was_training = self.net.training
         self.net.eval() # set net to evaluation mode
-        with torch.no_grad(): # no gradients needed
+        with torch.inference_mode(): # no gradients needed
             test_loss = self.get_loss(self.test_set, grad=False)
-        self.net.train() # set net back to training mode
+        self.net.train(was_training) # set net back to its previous mode
         return test_loss
 
     def get_reco_error(self, data):
+        was_training = self.net.training
         self.net.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             reco = self.net(data)[0]
-        self.net.train()
-        return torch.norm(data - reco, p='fro') / torch.norm(data, p='fro')
+        self.net.train(was_training)
+        return ((data - reco).pow(2).sum() / data.pow(2).sum()).sqrt()
     
-    def reconstruction_loss(self, q_hat, q):
-        reco_loss = (torch.norm((q_hat - q).flatten(1), p='fro') / torch.norm(q.flatten(1), p='fro')) ** 2
+    def reconstruction_loss(self, q_hat, q, q_norm_sq=None):
+        q_hat, q = q_hat.float(), q.float()
+        q_norm_sq = q.pow(2).sum() if q_norm_sq is None else q_norm_sq
+        reco_loss = (q_hat - q).pow(2).sum() / q_norm_sq
         return reco_loss
         
     def smoothness_loss(self, field):
-        field_norm = torch.norm(field.flatten(1), p='fro')
-        if field_norm == 0:
-            return 0
-        dfield_dx = F.conv2d(self.padx(field), self.Dx_kernel)
-        dfield_dy = F.conv2d(self.pady(field), self.Dy_kernel)
-        abs_grad_field = (torch.cat([dfield_dx, dfield_dy], 1)**2).sum(1).sqrt()
-        smoothness_loss = (torch.norm(abs_grad_field.flatten(1), p='fro') / field_norm) ** 2
+        field = field.float()
+        field_norm_sq = field.pow(2).sum()
+        if NUMBA_MODE and field.device.type == 'cpu' and not torch.is_grad_enabled():
+            # evaluation on the CPU: single fused pass over the field with numba
+            field_np = np.ascontiguousarray(field.detach().numpy())
+            grad_sq_sum = torch.tensor(_grad_sq_sum_numba(field_np, self.inv_dx, self.inv_dy), dtype=field.dtype)
+            return grad_sq_sum / field_norm_sq.clamp_min(torch.finfo(field.dtype).tiny)
+        # backward differences via slicing; replicate padding of the field makes the first row/column zero,
+        # so the padded entries do not contribute to the squared norm of the gradient and can be dropped.
+        # The differences are part of the autograd graph and can not be written into preallocated buffers
+        # (out= is not differentiable); the caching allocator reuses their memory between the steps.
+        dfield_dx = (field[:, :, 1:, :] - field[:, :, :-1, :]) * self.inv_dx
+        dfield_dy = (field[:, :, :, 1:] - field[:, :, :, :-1]) * self.inv_dy
+        grad_sq_sum = dfield_dx.pow(2).sum() + dfield_dy.pow(2).sum()
+        # a zero field has a zero gradient, clamping the norm gives a loss of 0 without a data dependent branch
+        smoothness_loss = grad_sq_sum / field_norm_sq.clamp_min(torch.finfo(field.dtype).tiny)
         return smoothness_loss
     
         
-    def get_loss(self, batch, grad=True):
-        batch = to_torch(batch, self.device)
-        
-        def loss_fn(batch_data):
-            loss = 0
-            q = batch_data
-            if self.net.has_bottleneck:
-                code, phi, q_hat = self.net(q, return_code=True, return_phi=True)
+    def _loss_fn(self, q, net, q_norm_sq=None):
+        loss = 0
+        if self.net.has_bottleneck:
+            code, phi, q_hat = net(q, return_code=True, return_phi=True)
+        else:
+            phi, q_hat = net(q, apply_f=True, return_phi=True)
+        loss += self.reconstruction_loss(q_hat, q, q_norm_sq)
+        if self.smooth_phi:
+            if hasattr(self.net, 'decoder') and hasattr(self.net.decoder, 'get_modes'):
+                modes = self.net.decoder.get_modes()[: , None, ...]
+                loss += self.smoothness_loss(modes) * self.smooth_phi
             else:
-                phi, q_hat = self.net(q, apply_f=True, return_phi=True)
-            loss += self.reconstruction_loss(q_hat, q)
-            if self.smooth_phi:
-                if hasattr(self.net, 'decoder') and hasattr(self.net.decoder, 'get_modes'):
-                    modes = self.net.decoder.get_modes()[: , None, ...]
-                    loss += self.smoothness_loss(modes) * self.smooth_phi
-                else:
-                    loss += self.smoothness_loss(phi) * self.smooth_phi
-            return loss
-        
+                loss += self.smoothness_loss(phi) * self.smooth_phi
+        return loss
+
+    def get_loss(self, batch, grad=True):
+        q_norm_sq = self._train_q_norm_sq if batch is self.train_set else None
+        batch = batch.to(memory_format=torch.channels_last)  # no-op for the train_set and test_set
         if grad:
-            loss = loss_fn(batch)
+            loss = self._loss_compiled(batch, self.train_net, q_norm_sq)
             return loss
         else:
-            with torch.no_grad():
-                loss = loss_fn(batch)
+            with torch.inference_mode():
+                loss = self._loss_fn(batch, self.net, q_norm_sq)
                 return loss
     
+    def _train_batches(self):
+        while True:
+            if self.loader is None:
+                yield self.train_set
+            else:
+                for batch, in self.loader:
+                    yield batch
+
     def training(self, trainsteps=1e5, test_every=1e3, save_every=5e3, log_base_name=''):
         log_folder = self.logs_folder + log_base_name + time.strftime("%Y_%m_%d__%H-%M", time.localtime()) + '/'
-        if not os.path.isdir(log_folder):
-            os.makedirs(log_folder)
-
-        self.tensorboard = SummaryWriter(log_dir=log_folder) if TB_MODE else None
-        save_codeBase(os.getcwd(), log_folder)
+        is_main = self.rank == 0
+        if is_main:
+            if not os.path.isdir(log_folder):
+                os.makedirs(log_folder)
+            self.tensorboard = SummaryWriter(log_dir=log_folder) if TB_MODE else None
+            save_codeBase(os.getcwd(), log_folder)
+            self._plot_executor = ThreadPoolExecutor(max_workers=1)
         
         test_loss = torch.zeros(1)
         train_loss_log = []
         test_loss_log = []
+        # the train losses stay on the device and are copied to the host in chunks of test_every steps
+        n_buf = int(test_every)
+        self._loss_buf = torch.empty(n_buf, device=self.device)
         
         #train loop
         best_so_far = 1e12
-        for step in range(int(trainsteps)):
+        batches = self._train_batches()
+        try:
+            for step in range(int(trainsteps)):
 
-            loss = self.get_loss(self.train_set)
-            self.optim.zero_grad()
-            loss.backward()
+                with torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+                    loss = self.get_loss(next(batches))
+                self.optim.zero_grad(set_to_none=True)
+                self.scaler.scale(loss).backward()
             
-            self.optim.step()
+                self.scaler.step(self.optim)
+                self.scaler.update()
             
-            train_loss_log.append([loss.item(), step])
-            if (step + 1) % save_every == 0:
-                self.net.save_net_weights(fpath=log_folder + 'net_weights/', fname='step_' + str(step) + '.pt')
-            # test/validate:
-            if (step + 1) % test_every == 0:
-                test_loss = self.test()
-                test_loss_log.append([test_loss.item(), step])
+                self._loss_buf[step % n_buf] = loss.detach()
+                if (step + 1) % n_buf == 0 or step + 1 == int(trainsteps):
+                    n = step % n_buf + 1
+                    for k, train_loss in enumerate(self._loss_buf[:n].to('cpu').numpy()):
+                        train_loss_log.append([train_loss, step + 1 - n + k])
+                        if self.tensorboard:
+                            self.tensorboard.add_scalar('train_loss', train_loss, step + 2 - n + k)
+                if is_main and (step + 1) % save_every == 0:
+                    self.net.save_net_weights(fpath=log_folder + 'net_weights/', fname='step_' + str(step) + '.pt')
+                # test/validate:
+                if is_main and (step + 1) % test_every == 0:
+                    self.net.eval()  # for the whole logging block, the helpers below keep the mode as it is
+                    test_loss = self.test()
+                    test_loss_log.append([test_loss.item(), step])
                 
-                reco_error = self.get_reco_error(self.test_set)
-                if reco_error < best_so_far:
-                    best_so_far = reco_error
-                    self.net.save_net_weights(fpath=log_folder + 'net_weights/', fname='best_results.pt')
-                    f = open(log_folder + 'net_weights/best_results.txt', 'w')
-                    f.write(f"step: {step} ;  Error: {reco_error:.3e}")
-                    f.close()
-                if self.tensorboard:
-                    fig_reco = self.plot_test_idx_reco()
-                    fig_modes = self.plot_modes()
-                    self.tensorboard.add_figure('reconstruction', fig_reco, global_step=step, close=True)
-                    if fig_modes is not None:
-                        self.tensorboard.add_figure('modes', fig_modes, global_step=step, close=True)
-                    self.tensorboard.add_figure('latents', plot_latents(self.test_set, self.net), global_step=step, close=True)
-                    self.tensorboard.add_scalar('test/loss', test_loss, step+1)
-                    self.tensorboard.add_scalar('test/rel_Error', reco_error, step+1)
+                    reco_error = self.get_reco_error(self.test_set)
+                    if reco_error < best_so_far:
+                        best_so_far = reco_error
+                        self.net.save_net_weights(fpath=log_folder + 'net_weights/', fname='best_results.pt')
+                        f = open(log_folder + 'net_weights/best_results.txt', 'w')
+                        f.write(f"step: {step} ;  Error: {reco_error:.3e}")
+                        f.close()
+                    if self.tensorboard:
+                        self.log_figures(step)
+                        self.tensorboard.add_scalar('test/loss', test_loss, step+1)
+                        self.tensorboard.add_scalar('test/rel_Error', reco_error, step+1)
+                    self.net.train()
                     
                     
-            if self.tensorboard:
-                self.tensorboard.add_scalar('train_loss', loss, step+1)
-                self.tensorboard.flush()
+                if self.tensorboard:
+                    self.tensorboard.flush()
 
-            if step % 100 == 0:
-                print(f"{step}: loss={loss.item():1.5}; test_loss={test_loss.item():1.5}", end="\r")
+                if is_main and step % 100 == 0:
+                    print(f"{step}: loss={loss.item():1.5}; test_loss={test_loss.item():1.5}", end="\r")
+        except BaseException:
+            self._stop_plotting(raise_errors=False)  # keep the original traceback of the training loop
+            raise
+        self._stop_plotting()
         return np.array(train_loss_log), np.array(test_loss_log)
     
+    def _stop_plotting(self, raise_errors=True):
+        if self._plot_executor is not None:
+            self._plot_executor.shutdown(wait=True)
+            self._plot_executor = None
+        if self._plot_future is not None:
+            future, self._plot_future = self._plot_future, None
+            if raise_errors:
+                future.result()  # raises the exceptions of the background thread
+
+    def log_figures(self, step):
+        if self._plot_future is not None:
+            if not self._plot_future.done():
+                return  # the figures of the last logging step are still being drawn, skip this one
+            future, self._plot_future = self._plot_future, None
+            future.result()  # raises the exceptions of the background thread
+        # evaluate the net on the main thread and start the (asynchronous) copies to the host
+        plot_idx = np.random.randint(self.test_set.shape[0])
+        truth = self.test_set[[plot_idx], ...]
+        was_training = self.net.training
+        self.net.eval()
+        with torch.inference_mode():
+            phi, q_hat = self.net(truth, return_phi=True)
+            code = self.net(self.test_set, return_code=True)[0]
+        self.net.train(was_training)
+        modes = None
+        if hasattr(self.net, 'decoder') and hasattr(self.net.decoder, 'get_modes'):
+            modes = self.net.decoder.get_modes(detach=True, device=self.device)
+        # copy=True: on the CPU the modes would otherwise still be a view of the weights that the optimizer updates
+        data = [None if t is None else t.detach().to('cpu', non_blocking=True, copy=True)
+                for t in [truth, q_hat, phi, code, modes]]
+        copied = None
+        if self.device.type == 'cuda':
+            copied = torch.cuda.Event()
+            copied.record()
+
+        # the tensorboard figures are plain matplotlib Figures (not pyplot) rendered by the Agg canvas of the
+        # SummaryWriter, so drawing them in the background thread does not depend on the GUI backend
+        if self._plot_executor is not None:
+            self._plot_future = self._plot_executor.submit(self._add_figures, step, copied, *data)
+        else:
+            self._add_figures(step, copied, *data)
+
+    def _add_figures(self, step, copied, truth, q_hat, phi, code, modes):
+        if copied is not None:
+            copied.synchronize()
+        fig_reco = plot_reconstrcution(truth, q_hat, phi, figures=self._figures)
+        self.tensorboard.add_figure('reconstruction', fig_reco, global_step=step, close=False)
+        if modes is not None:
+            self.tensorboard.add_figure('modes', plot_mode_fields(modes, figures=self._figures), global_step=step,
+                                        close=False)
+        self.tensorboard.add_figure('latents', plot_code(code, figures=self._figures), global_step=step, close=False)
+
     def plot_test_idx_reco(self, plot_idx=None):
         plot_idx = np.random.randint(self.test_set.shape[0]) if plot_idx is None else plot_idx
         truth = to_torch(self.test_set[[plot_idx], ...], self.device)
-        with torch.no_grad():
+        with torch.inference_mode():
+            was_training = self.net.training
             self.net.eval()
             phi, q_hat = self.net(truth, return_phi=True)
-            self.net.train()
+            self.net.train(was_training)
         return plot_reconstrcution(truth, q_hat, phi)
 
     def plot_modes(self):
         fig = None
         if hasattr(self.net, 'decoder') and hasattr(self.net.decoder, 'get_modes'):
             modes = self.net.decoder.get_modes(detach=True, device='cpu')
-            fig, axes = plt.subplots(1, modes.shape[0] , num=1, figsize=[19.2*modes.shape[0]/4, 10.8])
-            axes = [axes] if modes.shape[0] == 1 else axes
-            for n in range(modes.shape[0]):
-                im = axes[n].imshow(modes[n, ...].T, origin='lower')
-                plt.colorbar(im, ax=axes[n])
-                axes[n].set_title('mode '+str(n))
+            fig = plot_mode_fields(modes)
         return fig
 
-def plot_reconstrcution(truth, reco, phi=None):
-    p1 = (phi is not None) * 1
-    fig, axes = plt.subplots(1, 3 + p1, num=0, figsize=[19.2, 3.6])
-    dims_remove = [0] * (truth.ndim - 2) + [...]
-    if p1:
-        pc = axes[0].imshow(phi[dims_remove].to('cpu').T, origin='lower')
-        plt.colorbar(pc, ax=axes[0])
-        axes[0].set_title('$ \phi $')
-        axes[0].axis('equal')
-    pc = axes[0 + p1].imshow(reco[dims_remove].to('cpu').T, origin='lower')
-    axes[0 + p1].set_title('$ \^q $')
-    axes[0 + p1].axis('equal')
-    plt.colorbar(pc, ax=axes[0 + p1])
-    pc = axes[1 + p1].imshow(truth[dims_remove].to('cpu').T, origin='lower')
-    plt.colorbar(pc, ax=axes[1 + p1])
-    axes[1 + p1].set_title('$ q $')
-    axes[1 + p1].axis('equal')
-    pc = axes[2 + p1].imshow((reco - truth)[dims_remove].abs().to('cpu').T, origin='lower')
-    plt.colorbar(pc, ax=axes[2 + p1])
-    axes[2 + p1].set_title('$| \^q - q |$')
-    axes[2 + p1].axis('equal')
+def plot_image_row(name, fields, titles, figsize, axis_equal=False, num=None, figures=None):
+    # without figures a new pyplot figure is drawn, otherwise the figure stored under name in the dict figures
+    # is created on first use and only its image data are updated in later calls
+    fields = [np.asarray(field).T for field in fields]
+    if figures is not None and name in figures:
+        fig, images = figures[name]
+        for im, field in zip(images, fields):
+            im.set_data(field)
+            im.set_clim(vmin=field.min(), vmax=field.max())
+        return fig
+    fig = plt.figure(num=num, figsize=figsize, clear=True) if figures is None else Figure(figsize=figsize)
+    axes = fig.subplots(1, len(fields), squeeze=False)[0]
+    images = []
+    for ax, field, title in zip(axes, fields, titles):
+        images.append(ax.imshow(field, origin='lower'))
+        fig.colorbar(images[-1], ax=ax)
+        ax.set_title(title)
+        if axis_equal:
+            ax.axis('equal')
+    if figures is not None:
+        figures[name] = (fig, images)
     return fig
 
+def plot_mode_fields(modes, figures=None):
+    modes = modes.detach().to('cpu').numpy()
+    titles = ['mode ' + str(n) for n in range(modes.shape[0])]
+    return plot_image_row('modes', list(modes), titles, figsize=[19.2*modes.shape[0]/4, 10.8], num=1, figures=figures)
+
+def plot_reconstrcution(truth, reco, phi=None, figures=None):
+    dims_remove = tuple([0] * (truth.ndim - 2) + [...])
+    fields = [reco[dims_remove], truth[dims_remove], (reco - truth)[dims_remove].abs()]
+    titles = [r'$ \^q $', r'$ q $', r'$| \^q - q |$']
+    if phi is not None:
+        fields = [phi[dims_remove]] + fields
+        titles = [r'$ \phi $'] + titles
+    fields = [field.to('cpu') for field in fields]
+    return plot_image_row('reconstruction', fields, titles, figsize=[19.2, 3.6], axis_equal=True, num=0,
+                          figures=figures)
+
 def plot_latents(truth, net):
+    was_training = net.training
     net.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         code, phi, reco = net(truth, return_phi=True, return_code=True)
-    net.train()
-    fig = plt.figure()
-    for n in range(code.shape[1]):
-        plt.plot(code[:, n].to('cpu'), label=n)
-    plt.legend()
-    
+    net.train(was_training)
+    return plot_code(code)
+
+def plot_code(code, figures=None):
+    code = code.detach().to('cpu').numpy()
+    if figures is not None and 'latents' in figures:
+        fig, lines = figures['latents']
+        for n, line in enumerate(lines):
+            line.set_ydata(code[:, n])
+        fig.axes[0].relim()
+        fig.axes[0].autoscale_view()
+        return fig
+    fig = plt.figure() if figures is None else Figure()
+    ax = fig.subplots()
+    lines = [ax.plot(code[:, n], label=n)[0] for n in range(code.shape[1])]
+    ax.legend()
+    if figures is not None:
+        figures['latents'] = (fig, lines)
     return fig
     
     
 
 def show_video(truth, net, reps=10, pause=1):
+    was_training = net.training
     net.eval()
-    with torch.no_grad():
+    with torch.inference_mode():
         phi, reco = net(truth, return_phi=True)
-    net.train()
+    net.train(was_training)
 
     fig, axes = plt.subplots(1, 4, num=0, figsize=[19.2, 10.8])
     im = []